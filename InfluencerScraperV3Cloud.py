@@ -3,10 +3,17 @@ import streamlit as st
 import openai
 from apify_client import ApifyClient
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 import logging
-import numpy as np
 import json
+import heapq
+import re
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Optional
 
 # ---------------------------------------------------
 # 1. CONFIGURATIONS & SETUP
@@ -25,50 +32,115 @@ openai.api_key = st.secrets["openai"]["api_key"]
 # Apify token from secrets
 APIFY_API_TOKEN = st.secrets["apify"]["api_token"]
 
+# Shared Apify client; its underlying HTTP session keeps connections to api.apify.com alive
+APIFY_CLIENT = ApifyClient(APIFY_API_TOKEN)
+
+# Maximum number of usernames processed concurrently (keeps us within Apify rate limits)
+MAX_WORKERS = 10
+
+# Profiles above this follower count must mention one of these keywords in their bio
+# before we spend an Apify run on their posts (set to 0 to apply to every profile).
+# Keywords are regex fragments matched as whole words, so "ib" does not match "vibes";
+# compound hashtag forms such as "#IBDiploma" or "#InternationalBaccalaureate" are spelled out.
+BIO_KEYWORD_MIN_FOLLOWERS = 500_000
+BIO_KEYWORDS = {
+    r"ib(?:dp|myp|diploma|exams?)?", r"(?:international)?baccalaureate",
+    r"exams?", r"tutor\w*", r"students?"
+}
+# All keywords compiled into one whole-word pattern so each bio is scanned in a single pass;
+# each keyword gets its own named group so matches can be attributed to a keyword
+BIO_KEYWORDS_RE = re.compile(
+    r"\b(?:" + "|".join(
+        f"(?P<kw{i}>{k})" for i, k in enumerate(sorted(BIO_KEYWORDS, key=len, reverse=True))
+    ) + r")\b",
+    re.IGNORECASE
+)
+
+# How long scraped profiles and post stats are reused before Apify is asked again (seconds)
+SCRAPE_CACHE_TTL = 3600
+
 # Google Sheets Setup
 SCOPE = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
-service_account_info = json.loads(st.secrets["google"]["service_account"])
-CREDS = ServiceAccountCredentials.from_json_keyfile_dict(service_account_info, SCOPE)
-gc = gspread.authorize(CREDS)
 
 # Replace with your actual spreadsheet name or key
 SPREADSHEET_NAME = "InfluencerGiftingSourcing"
 
-# Try opening the sheet
-try:
-    sh = gc.open(SPREADSHEET_NAME)
-    logging.info(f"Successfully opened Google Sheet: {SPREADSHEET_NAME}")
-except Exception as e:
-    logging.error(f"Error opening Google Sheet: {e}")
-    raise e
-
-# Main worksheet for influencer data
-try:
-    main_worksheet = sh.worksheet("Main")
-    logging.info("Main worksheet found.")
-except Exception:
-    main_worksheet = sh.add_worksheet(title="Main", rows=1000, cols=20)
-    header = [
-        "Profile Pic URL", "Username", "Posts Count", "Followers Count", 
-        "Biography", "Instagram Profile Link",
-        "Median Comments (last 5)", "Median Likes (last 5)", "Engagement Rate"
-    ]
-    main_worksheet.insert_row(header, 1)
-    logging.info("Main worksheet created with header row.")
-
-# Second worksheet for hashtags
-try:
-    hashtag_worksheet = sh.worksheet("Hashtags")
-    logging.info("Hashtags worksheet found.")
-except Exception:
-    hashtag_worksheet = sh.add_worksheet(title="Hashtags", rows=1000, cols=10)
-    hashtag_header = ["Timestamp", "Hashtags Entered", "Used Hashtags"]
-    hashtag_worksheet.insert_row(hashtag_header, 1)
-    logging.info("Hashtags worksheet created with header row.")
+MAIN_HEADER = [
+    "Profile Pic URL", "Username", "Posts Count", "Followers Count", 
+    "Biography", "Instagram Profile Link",
+    "Median Comments (last 5)", "Median Likes (last 5)", "Engagement Rate"
+]
+HASHTAG_HEADER = ["Timestamp", "Hashtags Entered", "Used Hashtags"]
+SKIPPED_HEADER = [
+    "Timestamp", "Username", "Followers Count", "Posts Count",
+    "Bio Length", "Bio Keyword Hits", "Engagement Rate", "Reason"
+]
+
+@st.cache_resource
+def get_sheets():
+    """
+    Authorize with Google, open the spreadsheet and return
+    (sh, main_worksheet, hashtag_worksheet, skipped_worksheet),
+    creating any missing worksheet with its header row.
+    Cached for the lifetime of the Streamlit server so reruns skip the auth round-trip.
+    """
+    service_account_info = json.loads(st.secrets["google"]["service_account"])
+    creds = Credentials.from_service_account_info(service_account_info, scopes=SCOPE)
+    gc = gspread.authorize(creds)
+
+    # Try opening the sheet
+    try:
+        sh = gc.open(SPREADSHEET_NAME)
+        logging.info(f"Successfully opened Google Sheet: {SPREADSHEET_NAME}")
+    except Exception as e:
+        logging.error(f"Error opening Google Sheet: {e}")
+        raise e
+
+    # Look up both worksheets with a single metadata request
+    worksheets = {ws.title: ws for ws in sh.worksheets()}
+
+    # Main worksheet for influencer data
+    main_worksheet = worksheets.get("Main")
+    if main_worksheet is not None:
+        logging.info("Main worksheet found.")
+    else:
+        main_worksheet = sh.add_worksheet(title="Main", rows=1000, cols=20)
+        main_worksheet.insert_row(MAIN_HEADER, 1)
+        logging.info("Main worksheet created with header row.")
+
+    # Second worksheet for hashtags
+    hashtag_worksheet = worksheets.get("Hashtags")
+    if hashtag_worksheet is not None:
+        logging.info("Hashtags worksheet found.")
+    else:
+        hashtag_worksheet = sh.add_worksheet(title="Hashtags", rows=1000, cols=10)
+        hashtag_worksheet.insert_row(HASHTAG_HEADER, 1)
+        logging.info("Hashtags worksheet created with header row.")
+
+    # Audit worksheet for profiles skipped by the engagement prefilters
+    skipped_worksheet = worksheets.get("Skipped")
+    if skipped_worksheet is not None:
+        logging.info("Skipped worksheet found.")
+    else:
+        skipped_worksheet = sh.add_worksheet(title="Skipped", rows=1000, cols=10)
+        skipped_worksheet.insert_row(SKIPPED_HEADER, 1)
+        logging.info("Skipped worksheet created with header row.")
+
+    return sh, main_worksheet, hashtag_worksheet, skipped_worksheet
+
+sh, main_worksheet, hashtag_worksheet, skipped_worksheet = get_sheets()
+
+# Rows waiting to be written to the 'Hashtags' and main worksheets in a single batch
+pending_hashtag_rows = []
+pending_rows = []
+
+# Skipped-profile rows waiting to be written to the 'Skipped' worksheet; appended from worker threads
+pending_skipped_rows = []
+pending_skipped_lock = threading.Lock()
 
 # ---------------------------------------------------
 # 2. HELPER FUNCTIONS
@@ -76,79 +148,194 @@ except Exception:
 
 def append_hashtags_to_sheet(input_str: str, hashtags: list):
     """
-    Store the entered hashtags in the 'Hashtags' worksheet.
+    Queue the entered hashtags for the 'Hashtags' worksheet.
+    Rows are written by flush_pending_rows_to_sheet().
     """
-    from datetime import datetime
-    try:
-        hashtags_str = ", ".join(hashtags)
-        row = [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), input_str, hashtags_str]
-        hashtag_worksheet.append_row(row)
-        logging.info("Hashtags appended to 'Hashtags' worksheet.")
-    except Exception as e:
-        logging.error(f"Error appending hashtags to sheet: {e}")
+    hashtags_str = ", ".join(hashtags)
+    row = [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), input_str, hashtags_str]
+    pending_hashtag_rows.append(row)
+    logging.info("Hashtags queued for 'Hashtags' worksheet.")
+
+def collect_owner_usernames(dataset_id: str, unique_usernames: set):
+    """
+    Add the owner usernames from a hashtag dataset to unique_usernames.
+    """
+    for item in APIFY_CLIENT.dataset(dataset_id).iterate_items(fields=["ownerUsername"], clean=True):
+        if "ownerUsername" in item:
+            unique_usernames.add(item["ownerUsername"])
 
 def fetch_owner_usernames_from_hashtags(hashtags: list, results_limit: int) -> set:
     """
-    Call the Apify Instagram Hashtag Scraper for each hashtag,
+    Call the Apify Instagram Hashtag Scraper once for all hashtags,
     gather owner usernames from posts, and return a set of unique usernames.
+    Falls back to one run per hashtag if the combined run fails.
     """
-    client = ApifyClient(APIFY_API_TOKEN)
+    client = APIFY_CLIENT
     unique_usernames = set()
-    for htag in hashtags:
-        logging.info(f"Scraping hashtag: {htag}")
-        try:
-            run_input = {
-                "hashtags": [htag],
-                "resultsType": "posts",
-                "resultsLimit": results_limit
-            }
-            run = client.actor("reGe1ST3OBgYZSsZJ").call(run_input=run_input)
-            for item in client.dataset(run["defaultDatasetId"]).iterate_items():
-                if "ownerUsername" in item:
-                    unique_usernames.add(item["ownerUsername"])
-        except Exception as e:
-            logging.error(f"Error scraping hashtag {htag}: {e}")
+    logging.info(f"Scraping hashtags: {', '.join(hashtags)}")
+    try:
+        run_input = {
+            "hashtags": hashtags,
+            "resultsType": "posts",
+            "resultsLimit": results_limit  # Applied per hashtag by the actor.
+        }
+        run = client.actor("reGe1ST3OBgYZSsZJ").call(run_input=run_input)
+        # call() returns FAILED/ABORTED/TIMED-OUT runs instead of raising
+        if not run or run.get("status") != "SUCCEEDED":
+            raise RuntimeError(f"actor run ended with status {run.get('status') if run else None}")
+        collect_owner_usernames(run["defaultDatasetId"], unique_usernames)
+    except Exception as e:
+        logging.error(f"Error scraping hashtags in a single run, retrying per hashtag: {e}")
+        # Start every run before waiting on any, so the actors run in parallel on Apify's side
+        runs = {}
+        for htag in hashtags:
+            logging.info(f"Scraping hashtag: {htag}")
+            try:
+                run_input = {
+                    "hashtags": [htag],
+                    "resultsType": "posts",
+                    "resultsLimit": results_limit
+                }
+                runs[htag] = client.actor("reGe1ST3OBgYZSsZJ").start(run_input=run_input)
+            except Exception as e:
+                logging.error(f"Error starting scrape for hashtag {htag}: {e}")
+        for htag, run in runs.items():
+            try:
+                run = client.run(run["id"]).wait_for_finish()
+                if not run or run.get("status") != "SUCCEEDED":
+                    raise RuntimeError(f"actor run ended with status {run.get('status') if run else None}")
+                collect_owner_usernames(run["defaultDatasetId"], unique_usernames)
+            except Exception as e:
+                logging.error(f"Error scraping hashtag {htag}: {e}")
     logging.info(f"Total unique usernames found: {len(unique_usernames)}")
     return unique_usernames
 
-def user_already_in_sheet(username: str) -> bool:
+def fetch_existing_usernames() -> tuple:
     """
-    Checks if a username is already present in the main worksheet.
+    Read the existing usernames and all header rows in a single batchGet request.
+    Return (usernames, missing_headers): the usernames as a frozenset, and a list of
+    (worksheet, header) pairs for worksheets whose header row has been cleared.
+    Read-only; pass missing_headers to restore_header_rows().
     """
     try:
-        usernames_col = main_worksheet.col_values(2)  # Username is in the second column.
-        return username in usernames_col
+        response = sh.values_batch_get(["Main!B2:B", "Main!1:1", "Hashtags!1:1", "Skipped!1:1"])
+        usernames_rows, main_header_row, hashtag_header_row, skipped_header_row = [
+            value_range.get("values", []) for value_range in response["valueRanges"]
+        ]
     except Exception as e:
-        logging.error(f"Error checking existing usernames in sheet: {e}")
-        return False
+        logging.error(f"Error reading existing usernames from sheet: {e}")
+        return frozenset(), []
+    missing_headers = [
+        (worksheet, header)
+        for worksheet, header, header_row in (
+            (main_worksheet, MAIN_HEADER, main_header_row),
+            (hashtag_worksheet, HASHTAG_HEADER, hashtag_header_row),
+            (skipped_worksheet, SKIPPED_HEADER, skipped_header_row),
+        )
+        if not header_row
+    ]
+    return frozenset(row[0] for row in usernames_rows if row), missing_headers
 
-def scrape_profile_info(username: str):
+def restore_header_rows(missing_headers: list):
     """
-    Scrape Instagram profile info using Apify and return the profile data as a dictionary.
+    Write the header row back into each worksheet returned by fetch_existing_usernames()
+    as missing one.
     """
-    client = ApifyClient(APIFY_API_TOKEN)
-    try:
-        run_input = {"usernames": [username]}
-        run = client.actor("dSCLg0C3YEZ83HzYX").call(run_input=run_input)
-        data_items = list(client.dataset(run["defaultDatasetId"]).iterate_items())
-        if not data_items:
-            logging.warning(f"No profile data returned for {username}")
-            return None
-        profile_data = data_items[0]
-        return {
+    for worksheet, header in missing_headers:
+        try:
+            worksheet.update(range_name="A1", values=[header])
+            logging.info(f"Header row restored in '{worksheet.title}' worksheet.")
+        except Exception as e:
+            logging.error(f"Error restoring header row in '{worksheet.title}' worksheet: {e}")
+
+def user_already_in_sheet(username: str, existing: frozenset) -> bool:
+    """
+    Checks if a username is already present in the cached set of sheet usernames.
+    """
+    return username in existing
+
+@st.cache_resource
+def _profile_cache() -> tuple:
+    """
+    Per-username profile cache shared across Streamlit reruns and sessions, with its lock.
+    Maps username -> (scraped_at, profile_data), where profile_data is None if Apify had no data.
+    """
+    return {}, threading.Lock()
+
+def _run_profile_scraper(usernames: list) -> dict:
+    """
+    Run the Apify profile scraper once for all usernames and index the results by username.
+    Errors propagate to the caller.
+    """
+    client = APIFY_CLIENT
+    run_input = {"usernames": usernames}
+    run = client.actor("dSCLg0C3YEZ83HzYX").call(run_input=run_input)
+    # call() returns FAILED/ABORTED/TIMED-OUT runs instead of raising
+    if not run or run.get("status") != "SUCCEEDED":
+        raise RuntimeError(f"actor run ended with status {run.get('status') if run else None}")
+    profiles = {}
+    for profile_data in client.dataset(run["defaultDatasetId"]).iterate_items(
+        fields=["username", "profilePicUrl", "postsCount", "followersCount", "biography"],
+        clean=True
+    ):
+        username = profile_data.get("username")
+        if not username:
+            continue
+        profiles[username] = {
             "username": username,
             "profile_pic_url": profile_data.get("profilePicUrl", ""),
             "posts_count": profile_data.get("postsCount", 0),
             "followers_count": profile_data.get("followersCount", 0),
             "biography": profile_data.get("biography", "")
         }
+    return profiles
+
+def scrape_profiles_batch(usernames: list) -> dict:
+    """
+    Scrape Instagram profile info for all usernames and return a dictionary mapping
+    each username to its profile data. Profiles scraped within SCRAPE_CACHE_TTL are
+    reused; only the remaining usernames are sent to Apify, in a single run.
+    """
+    cache, lock = _profile_cache()
+    profiles = {}
+    misses = []
+    with lock:
+        # Evict expired entries so the cache does not grow for the lifetime of the server
+        now = time.time()
+        for username in [u for u, (scraped_at, _) in cache.items() if now - scraped_at >= SCRAPE_CACHE_TTL]:
+            del cache[username]
+        for username in usernames:
+            if username in cache:
+                if cache[username][1] is not None:
+                    profiles[username] = cache[username][1]
+            else:
+                misses.append(username)
+    logging.info(f"Profile cache: {len(usernames) - len(misses)} hits, {len(misses)} to scrape.")
+    if not misses:
+        return profiles
+
+    try:
+        scraped = _run_profile_scraper(misses)
     except Exception as e:
-        logging.error(f"Error scraping profile info for {username}: {e}")
-        return None
+        logging.error(f"Error scraping profile info; lost profile data for all {len(misses)} uncached usernames this run: {e}")
+        return profiles
+
+    scraped_at = time.time()
+    missing = [u for u in misses if u not in scraped]
+    with lock:
+        for username, profile_data in scraped.items():
+            cache[username] = (scraped_at, profile_data)
+        for username in missing:
+            cache[username] = (scraped_at, None)
+    profiles.update(scraped)
+    if missing:
+        logging.warning(f"No profile data returned for {len(missing)} usernames")
+    return profiles
 
 def append_profile_to_sheet(profile_data: dict, median_comments: int, median_likes: int, engagement_rate: float):
     """
-    Append the qualifying profile data along with engagement metrics to the main worksheet.
+    Queue the qualifying profile data along with engagement metrics for the main worksheet.
+    Rows are written by flush_pending_rows_to_sheet().
     """
     row = [
         profile_data["profile_pic_url"],
@@ -161,37 +348,174 @@ def append_profile_to_sheet(profile_data: dict, median_comments: int, median_lik
         str(median_likes),
         f"{engagement_rate:.2f}"
     ]
-    main_worksheet.append_row(row)
-    logging.info(f"Stored profile data for {profile_data['username']}")
+    pending_rows.append(row)
+    logging.info(f"Queued profile data for {profile_data['username']}")
+
+def record_skipped_profile(profile_data: dict, reason: str, engagement_rate: Optional[float] = None):
+    """
+    Queue a profile skipped by the engagement prefilters for the 'Skipped' worksheet,
+    together with the features available before the posts scrape. Together with the
+    'Main' rows this builds up labelled data for tuning the prefilters.
+    Safe to call from worker threads.
+    """
+    row = [
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        profile_data["username"],
+        profile_data["followers_count"],
+        profile_data["posts_count"],
+        len(profile_data["biography"]),
+        bio_keyword_hits(profile_data["biography"]),
+        "" if engagement_rate is None else f"{engagement_rate:.2f}",
+        reason
+    ]
+    with pending_skipped_lock:
+        pending_skipped_rows.append(row)
+
+def _append_cells_request(worksheet, rows: list) -> dict:
+    """
+    Build a Sheets API appendCells request adding rows to the end of the worksheet.
+    Numbers are written as numbers and everything else as literal text.
+    """
+    return {
+        "appendCells": {
+            "sheetId": worksheet.id,
+            "rows": [
+                {
+                    "values": [
+                        {"userEnteredValue": {"numberValue": v} if isinstance(v, (int, float)) else {"stringValue": str(v)}}
+                        for v in row
+                    ]
+                }
+                for row in rows
+            ],
+            "fields": "userEnteredValue"
+        }
+    }
+
+def flush_pending_rows_to_sheet() -> bool:
+    """
+    Write all queued rows. Profile rows go to the main worksheet in their own append
+    call, written RAW so scraped text (e.g. a bio starting with '=') is never parsed as
+    a formula; the 'Hashtags' and 'Skipped' rows follow in a single batchUpdate request.
+    Returns False if any write failed.
+    """
+    success = True
+    if pending_rows:
+        try:
+            main_worksheet.append_rows(pending_rows, value_input_option="RAW")
+            logging.info(f"Stored {len(pending_rows)} rows in '{main_worksheet.title}' worksheet.")
+            pending_rows.clear()
+        except Exception as e:
+            logging.error(f"Error appending profiles to sheet: {e}")
+            success = False
+    with pending_skipped_lock:
+        batches = [
+            (hashtag_worksheet, pending_hashtag_rows),
+            (skipped_worksheet, pending_skipped_rows),
+        ]
+        requests = [_append_cells_request(ws, rows) for ws, rows in batches if rows]
+        if not requests:
+            return success
+        try:
+            sh.batch_update({"requests": requests})
+            for ws, rows in batches:
+                if rows:
+                    logging.info(f"Stored {len(rows)} rows in '{ws.title}' worksheet.")
+                    rows.clear()
+        except Exception as e:
+            logging.error(f"Error appending rows to sheet: {e}")
+            success = False
+    return success
+
+@st.cache_data(ttl=SCRAPE_CACHE_TTL, show_spinner=False)
+def _cached_last_5_posts_stats(username: str, limit: int):
+    """
+    Run the Apify post scraper for a username and compute median likes and comments.
+    Results are cached for an hour; errors propagate so that failed scrapes are not cached.
+    """
+    client = APIFY_CLIENT
+    run_input = {
+        "username": [username],
+        "resultsLimit": limit
+    }
+    run = client.actor("nH2AHrwxeTRJoN5hX").call(run_input=run_input)
+    posts = list(client.dataset(run["defaultDatasetId"]).iterate_items(
+        fields=["likesCount", "commentsCount", "takenAtTimestamp"],
+        clean=True
+    ))
+    if not posts:
+        logging.warning(f"No posts found for {username}")
+        return 0, 0
+    recent_posts = heapq.nlargest(5, posts, key=lambda x: x.get("takenAtTimestamp", 0))
+    likes_list = [p.get("likesCount", 0) for p in recent_posts]
+    comments_list = [p.get("commentsCount", 0) for p in recent_posts]
+    if not likes_list:
+        return 0, 0
+    median_likes = int(statistics.median(likes_list))
+    median_comments = int(statistics.median(comments_list))
+    return median_likes, median_comments
 
 def get_last_5_posts_stats(username: str, limit: int = 30):
     """
     Use Apify to scrape the user's most recent posts.
-    Return the median likes and median comments for the last 5 (or fewer) posts.
+    Return the median likes and median comments for the last 5 (or fewer) posts,
+    or None if the scrape failed.
     """
-    client = ApifyClient(APIFY_API_TOKEN)
     try:
-        run_input = {
-            "username": [username],
-            "resultsLimit": limit
-        }
-        run = client.actor("nH2AHrwxeTRJoN5hX").call(run_input=run_input)
-        posts = list(client.dataset(run["defaultDatasetId"]).iterate_items())
-        if not posts:
-            logging.warning(f"No posts found for {username}")
-            return 0, 0
-        posts.sort(key=lambda x: x.get("takenAtTimestamp", 0), reverse=True)
-        recent_posts = posts[:8]
-        likes_list = [p.get("likesCount", 0) for p in recent_posts]
-        comments_list = [p.get("commentsCount", 0) for p in recent_posts]
-        if not likes_list:
-            return 0, 0
-        median_likes = int(np.median(likes_list))
-        median_comments = int(np.median(comments_list))
-        return median_likes, median_comments
+        return _cached_last_5_posts_stats(username, limit)
     except Exception as e:
         logging.error(f"Error scraping posts for {username}: {e}")
-        return 0, 0
+        return None
+
+def bio_keyword_hits(biography: str) -> int:
+    """
+    Count how many distinct BIO_KEYWORDS the biography mentions as whole words (case-insensitive).
+    Keywords only count when they stand alone, so "studentutor" scores 0.
+    """
+    return len({m.lastgroup for m in BIO_KEYWORDS_RE.finditer(biography)})
+
+def bio_has_keyword(biography: str) -> bool:
+    """
+    Checks if the biography mentions at least one of BIO_KEYWORDS as a whole word (case-insensitive).
+    """
+    return BIO_KEYWORDS_RE.search(biography) is not None
+
+def process_one(profile_data: dict) -> Optional[tuple]:
+    """
+    Run the per-profile pipeline: apply the follower/post filter,
+    fetch recent post stats and compute the engagement rate.
+    Return the arguments for append_profile_to_sheet() if the profile qualifies, else None.
+    """
+    username = profile_data["username"]
+    
+    # Filtering criteria for the IB/ed-tech space: lower thresholds are applied.
+    if not (profile_data["followers_count"] > 1000 and profile_data["posts_count"] > 5):
+        return None
+    
+    # Cheap bio check before the expensive posts scrape
+    if profile_data["followers_count"] > BIO_KEYWORD_MIN_FOLLOWERS and not bio_has_keyword(profile_data["biography"]):
+        logging.info(f"Skipping {username}, no IB keywords in bio.")
+        record_skipped_profile(profile_data, "No bio keywords")
+        return None
+    
+    stats = get_last_5_posts_stats(username, limit=30)
+    if stats is None:
+        # Not a low-engagement label: keep it apart so the audit data stays clean
+        record_skipped_profile(profile_data, "Posts scrape failed")
+        return None
+    median_likes, median_comments = stats
+    if profile_data["followers_count"] > 0:
+        engagement_rate = ((median_likes + median_comments) / profile_data["followers_count"]) * 100
+    else:
+        engagement_rate = 0
+    
+    # Only include profiles with an engagement rate of at least 0.5%
+    if engagement_rate < 0.5:
+        logging.info(f"Skipping {username} due to low engagement rate: {engagement_rate:.2f}%")
+        record_skipped_profile(profile_data, "Low engagement", engagement_rate)
+        return None
+    
+    return profile_data, median_comments, median_likes, engagement_rate
 
 # ---------------------------------------------------
 # 3. STREAMLIT APP
@@ -219,36 +543,42 @@ def main():
         
         st.success(f"Using {len(hashtags)} hashtags: {', '.join(hashtags)}")
         
-        # Append the entered hashtags to the Hashtags worksheet
+        # Queue the entered hashtags for the Hashtags worksheet
         append_hashtags_to_sheet(hashtags_input, hashtags)
         
-        # Fetch unique owner usernames from the scraped hashtags
-        unique_usernames = fetch_owner_usernames_from_hashtags(hashtags, results_limit)
+        # Read the usernames already stored in the sheet (once, instead of per username)
+        # while the hashtag actor runs.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            existing_future = executor.submit(fetch_existing_usernames)
+            unique_usernames = fetch_owner_usernames_from_hashtags(hashtags, results_limit)
+            existing, missing_headers = existing_future.result()
+        restore_header_rows(missing_headers)
+        
+        # Only process usernames that are not in the sheet yet
+        new_usernames = [u for u in unique_usernames if not user_already_in_sheet(u, existing)]
+        logging.info(f"Skipping {len(unique_usernames) - len(new_usernames)} usernames already in sheet.")
+        
+        # Scrape all new, uncached profiles in a single Apify run
+        profiles = scrape_profiles_batch(new_usernames)
         
-        # Process each username: scrape profile info, calculate engagement, and append qualifying profiles to the sheet.
-        for username in unique_usernames:
-            if user_already_in_sheet(username):
-                logging.info(f"Skipping {username}, already in sheet.")
-                continue
-            
-            profile_data = scrape_profile_info(username)
-            if profile_data is None:
-                continue
-            
-            # Filtering criteria for the IB/ed-tech space: lower thresholds are applied.
-            if profile_data["followers_count"] > 1000 and profile_data["posts_count"] > 5:
-                median_likes, median_comments = get_last_5_posts_stats(username, limit=30)
-                if profile_data["followers_count"] > 0:
-                    engagement_rate = ((median_likes + median_comments) / profile_data["followers_count"]) * 100
-                else:
-                    engagement_rate = 0
-                
-                # Only include profiles with an engagement rate of at least 0.5%
-                if engagement_rate < 0.5:
-                    logging.info(f"Skipping {username} due to low engagement rate: {engagement_rate:.2f}%")
+        # Fetch recent post stats concurrently and keep the profiles that qualify.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(process_one, p): u for u, p in profiles.items()}
+            for future in as_completed(futures):
+                username = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing {username}: {e}")
                     continue
-                
-                append_profile_to_sheet(profile_data, median_comments, median_likes, engagement_rate)
+                if result is None:
+                    continue
+                append_profile_to_sheet(*result)
+        
+        # Write the qualifying profiles, then the hashtags and skipped profiles in a single batch
+        if not flush_pending_rows_to_sheet():
+            st.error("Scraping finished, but some rows could not be written to Google Sheets. Check the logs for details.")
+            return
         
         st.success("Scraping and data append complete. Please check Google Sheets for results.")
 